@@ -1,16 +1,21 @@
 import os
-import re
+import io
 import math
-import time
-import requests
 import pandas as pd
+from contextlib import contextmanager
 from dotenv import load_dotenv
 
+from backend_client import get
+
 #                        backend_auxiliar.py
 # This file save all routines for run the backend routines.
 # Backend routines:
-# 1. r_observed_data.py
+# 1. r_observed_data_db.py
 # 2. r_station_db.py
+# 3. r_forecast_db.py
+# 4. r_forecast_record_db.py
+# 5. r_historical_simulation_db.py
+# 6. backend_thresholds.py
 #
 #
 
@@ -30,85 +35,58 @@ def get_station_info():
 	return db
 
 
-def data_request(url, params, cnt_fail=0) -> pd.DataFrame:
+@contextmanager
+def data_stream(url, params):
 	"""
-	Make a recursive request form url for 3 times
+	Make a request form url with the shared client and return the body as
+	a stream, so the data is parsed while it is downloaded. The response
+	is requested compressed and decoded in the stream. The connection is
+	released at the end of the with block.
 	Input : 
 		url    : str  -> url to make request
 		params : dict -> Dictionary with the params of request
 	Return:
-		"ERROR"      -> When the requests does not exist
-		content.text -> When success the request
+		"ERROR"     -> When the requests does not exist
+		file object -> When success the request
 	"""
-	# Make recursive request routine
-	data = requests.get(url, params)
-	# status_code = data.status_code
+	data = get(url, params, stream = True)
 
-	if data.status_code == 200:
-		# Success condition
-		rv = data.text
-		data.close()
-		return rv
-	elif data.status_code != 200 and cnt_fail > 5:
+	if data is None:
 		# Condition failure
-		data.close()
 		print('Download fail')
-		return "ERROR"
-	else:
-		# Condition restart
-		# print('Try : {}'.format(cnt_fail))
+		yield "ERROR"
+		return
+
+	# Success condition
+	data.raw.decode_content = True
+	try:
+		yield data.raw
+	finally:
 		data.close()
-		time.sleep(1)
-		cnt_fail += 1
-		return data_request(url, params, cnt_fail=cnt_fail)
 
 
-def get_data_wfs(url, id_HS, layer) -> list:
+def read_csv_data(input_data, date_col, date_format, dtypes = None) -> pd.DataFrame:
 	"""
-	Read wfs hydroshare data
-	parametres:
-	    url : str  = URL for download the ows file.
+	Build a dataframe from a csv with a vectorized parse. The types of the
+	columns are declared before the parse and the datetime column is
+	parsed in bulk and used as index.
+	Input :
+		input_data  : str/bytes/file -> Content of the csv or stream of the response
+		date_col    : str            -> Datetime column name
+		date_format : str            -> Datetime column format
+		dtypes      : dict           -> Type of the data columns
 	Return:
-	    rv  : list = list with the data of the WFS.
+		pandas.DataFrame -> Table with the datetime index
 	"""
-	# Extract hydroshare data
-	status_fail = True
-	cnt = 0
-	while status_fail:
-		cont = requests.get(url)
-		if cont.status_code < 400:
-			status_fail = False
-			rv = cont.text
-			cont.close()
-			cont = rv
-		if cnt > 5:
-			cont.close()
-			print('Error in {} download.'.format(url))
-			return []
-		cnt += 1
-		
+	# The bytes are not decoded to str
+	if isinstance(input_data, str):
+		input_data = io.StringIO(input_data)
+	elif isinstance(input_data, (bytes, bytearray)):
+		input_data = io.BytesIO(input_data)
 
-	# Split by feature
-	patron_main = r"<{0}:{1}(.*?)</{0}:{1}>".format(id_HS, layer)
-	data = re.findall(patron_main, cont)
+	dtypes = dict(dtypes or {})
+	dtypes[date_col] = str
 
-	# Fix data
-	rv = []
-	for data_by_feature in data:
-		patron_table = r'<{0}:(.*?)</{0}:'.format(id_HS)
-        
-		name_row  = lambda x : 'the_geom' if 'the_geom' in x \
-                                          else x.split('>')[0]
-
-		value_row = lambda x : [ii for ii in re.findall('>(.*?)<', x) \
-                                                        if ',' in ii] \
-                                if 'the_geom' in x else x.split('>')[1]
-
-		data_by_feature_slice = {name_row(row) : value_row(row) for row\
-                                 in re.findall(patron_table,
-                                               data_by_feature)}
-        
-		rv.append(data_by_feature_slice)
-        
+	rv = pd.read_csv(input_data, engine = 'c', dtype = dtypes, index_col = date_col)
+	rv.index = pd.to_datetime(rv.index, format = date_format)
 	return rv
-
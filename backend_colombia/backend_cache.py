@@ -0,0 +1,148 @@
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+
+#                        backend_cache.py
+# This file save the on-disk response cache of the HTTP client. The
+# responses are saved by url and params with the ETag, the Last-Modified
+# and the hash of the content, so the unchanged responses are detected
+# and the parse and database writes are skipped.
+# Backend routines:
+# 1. backend_client.py
+# 2. r_forecast_db.py
+# 3. r_observed_data_db.py
+# 4. r_daily_ingest.py
+#
+
+
+# Default size of the cache
+CACHE_DIR       = os.path.join('.', 'cache', 'http')
+CACHE_MAX_BYTES = 4 * 1024 ** 3
+
+
+class Response_cache:
+	"""
+	Size bounded on-disk cache with LRU eviction. The index is saved in a
+	sqlite database and the content of the responses in files.
+	"""
+	def __init__(self, path = CACHE_DIR, max_bytes = CACHE_MAX_BYTES):
+		self.path      = path
+		self.max_bytes = max_bytes
+		self.lock      = threading.Lock()
+
+		os.makedirs(self.path, exist_ok = True)
+		self.conn = sqlite3.connect(os.path.join(self.path, 'index.db'),
+									check_same_thread = False)
+		with self.lock, self.conn:
+			self.conn.execute('create table if not exists entries ('
+							  'key text primary key, '
+							  'url text, '
+							  'etag text, '
+							  'last_modified text, '
+							  'digest text, '
+							  'size integer, '
+							  'accessed real)')
+			self.conn.execute('create index if not exists entries_accessed on entries (accessed)')
+
+
+	def key(self, url, params = None) -> str:
+		# Key of the url and params
+		params = {str(key) : str(val) for key, val in (params or {}).items()}
+		return hashlib.sha256(json.dumps([url, params], sort_keys = True).encode('utf-8')).hexdigest()
+
+
+	def conditional_headers(self, key) -> dict:
+		"""
+		Headers for make a conditional request. Empty if the response is
+		not in the cache.
+		"""
+		with self.lock:
+			row = self.conn.execute('select etag, last_modified from entries where key = ?',
+									(key, )).fetchone()
+		if row is None or not os.path.exists(self.__body_path__(key)):
+			return {}
+
+		rv = {}
+		if row[0]:
+			rv['If-None-Match'] = row[0]
+		if row[1]:
+			rv['If-Modified-Since'] = row[1]
+		return rv
+
+
+	def is_unchanged(self, key, body : bytes) -> bool:
+		# Compare the hash of the content with the saved response
+		with self.lock:
+			row = self.conn.execute('select digest from entries where key = ?', (key, )).fetchone()
+		return row is not None and row[0] == hashlib.sha256(body).hexdigest()
+
+
+	def load(self, key) -> bytes:
+		"""
+		Read the content of the response. None if the response is not in
+		the cache.
+		"""
+		try:
+			with open(self.__body_path__(key), 'rb') as f:
+				rv = f.read()
+		except FileNotFoundError:
+			return None
+		self.touch(key)
+		return rv
+
+
+	def touch(self, key, headers = None):
+		# Update the access time and the validators of the response
+		with self.lock, self.conn:
+			self.conn.execute('update entries set accessed = ? where key = ?', (time.time(), key))
+			if headers is not None:
+				self.conn.execute('update entries set etag = coalesce(?, etag), '
+								  'last_modified = coalesce(?, last_modified) where key = ?',
+								  (headers.get('ETag'), headers.get('Last-Modified'), key))
+
+
+	def save(self, key, url, headers, body : bytes):
+		"""
+		Save the response and remove the least recently used responses if
+		the cache exceeds the maximum size.
+		"""
+		tmp_file = self.__body_path__(key) + '.tmp'
+		with open(tmp_file, 'wb') as f:
+			f.write(body)
+		os.replace(tmp_file, self.__body_path__(key))
+
+		with self.lock, self.conn:
+			self.conn.execute('insert or replace into entries values (?, ?, ?, ?, ?, ?, ?)',
+							  (key,
+							   url,
+							   headers.get('ETag'),
+							   headers.get('Last-Modified'),
+							   hashlib.sha256(body).hexdigest(),
+							   len(body),
+							   time.time()))
+		self.__evict__()
+
+
+	def __evict__(self):
+		with self.lock, self.conn:
+			total = self.conn.execute('select coalesce(sum(size), 0) from entries').fetchone()[0]
+			if total <= self.max_bytes:
+				return
+
+			rows = self.conn.execute('select key, size from entries order by accessed').fetchall()
+			for key, size in rows:
+				if total <= self.max_bytes:
+					break
+				self.conn.execute('delete from entries where key = ?', (key, ))
+				try:
+					os.remove(self.__body_path__(key))
+				except FileNotFoundError:
+					pass
+				total -= size
+
+
+	def __body_path__(self, key) -> str:
+		return os.path.join(self.path, key + '.body')
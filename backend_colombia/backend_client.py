@@ -0,0 +1,640 @@
+import time
+import random
+import asyncio
+import aiohttp
+import requests
+import threading
+import concurrent.futures
+import email.utils as eut
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+#                        backend_client.py
+# This file save the HTTP client shared by the backend routines. All
+# requests use the same connection pool, the same backoff policy, the
+# same circuit breaker by host, the same adaptive concurrency limit by
+# endpoint and, optionally, the response cache of backend_cache.py.
+# Backend routines:
+# 1. backend_auxiliar.py
+# 2. r_forecast_db.py
+# 3. r_forecast_record_db.py
+# 4. r_daily_ingest.py
+# 5. r_observed_data_db.py
+# 6. r_historical_simulation_db.py
+# 7. r_fews_stations.py
+
+
+# Retry policy
+BACKOFF_BASE    = 1     # Seconds
+BACKOFF_CAP     = 60    # Seconds
+RETRIES         = 6
+NOT_RETRY       = (404, 410)
+
+# Pool size of the shared session
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE     = 50
+
+# Adaptive concurrency by endpoint
+LIMIT_START     = 4
+LIMIT_FLOOR     = 1
+LIMIT_CEILING   = POOL_MAXSIZE
+LATENCY_FACTOR  = 2.0   # Latency over the base latency where the limit stops growing
+
+_session      = None
+_session_lock = threading.Lock()
+
+
+class Circuit_breaker:
+	"""
+	Circuit breaker by host. After threshold consecutive failures the
+	circuit is opened and all the requests to the host wait the cooldown
+	time. After the cooldown, the requests are allowed again and the
+	circuit is closed with the first success.
+	"""
+	def __init__(self, host, threshold = 10, cooldown = 30):
+		self.host      = host
+		self.threshold = threshold
+		self.cooldown  = cooldown
+		self.failures  = 0
+		self.open_to   = 0
+		self.lock      = threading.Lock()
+
+	def remaining(self) -> float:
+		# Seconds to wait before make a new request
+		with self.lock:
+			return max(self.open_to - time.monotonic(), 0)
+
+	def success(self):
+		with self.lock:
+			self.failures = 0
+
+	def failure(self, delay = 0):
+		# delay : Seconds requested by the server (Retry-After)
+		with self.lock:
+			self.failures += 1
+			wait = delay
+			if self.failures >= self.threshold:
+				wait = max(wait, self.cooldown)
+				self.failures = 0
+				print('Circuit open for {} : {:.0f} seg'.format(self.host, wait))
+			if wait > 0:
+				self.open_to = max(self.open_to, time.monotonic() + wait)
+
+
+_breakers      = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(url) -> Circuit_breaker:
+	"""
+	Return the circuit breaker of the host of the url
+	"""
+	host = urlsplit(url).netloc
+	with _breakers_lock:
+		if host not in _breakers:
+			_breakers[host] = Circuit_breaker(host)
+		return _breakers[host]
+
+
+class Adaptive_limit:
+	"""
+	Concurrency limit by endpoint with additive increase and multiplicative
+	decrease (AIMD). The limit starts low and grows while the responses are
+	2xx and the latency is near the base latency of the endpoint: one
+	request by response in the slow start (the limit doubles by round),
+	one request by round after the first decrease. With a 429 or 5xx
+	response, or a connection error, the limit is halved. Only the first
+	try of each request counts for the decrease, the retries of a request
+	that keeps failing do not reduce the limit again. Only one decrease is
+	made by round of requests (the failures of the requests started before
+	the last decrease are ignored), so a burst of failures halves the limit
+	once.
+	"""
+	def __init__(self, endpoint, start = LIMIT_START, floor = LIMIT_FLOOR, ceiling = LIMIT_CEILING):
+		self.endpoint     = endpoint
+		self.limit        = float(start)
+		self.floor        = floor
+		self.ceiling      = ceiling
+		self.in_flight    = 0
+		self.base_latency = None
+		self.latency      = None
+		self.slow_start   = True
+		self.decreased    = 0
+		self.cond         = threading.Condition()
+
+	def size(self) -> int:
+		# Number of requests allowed in flight
+		return max(int(min(self.limit, self.ceiling)), self.floor)
+
+	def try_acquire(self) -> bool:
+		with self.cond:
+			if self.in_flight < self.size():
+				self.in_flight += 1
+				return True
+			return False
+
+	def acquire(self):
+		with self.cond:
+			while self.in_flight >= self.size():
+				self.cond.wait()
+			self.in_flight += 1
+
+	async def acquire_async(self):
+		while not self.try_acquire():
+			await asyncio.sleep(0.05)
+
+	def release(self, start, status = None, latency = None, retry = False):
+		"""
+		Free the request and update the limit with the result.
+		Input :
+			start   : float -> time.monotonic() when the request started
+			status  : int   -> Status of the response. None for connection errors
+			latency : float -> Seconds to receive the response
+			retry   : bool  -> True if the request is a retry of a failed request
+		"""
+		with self.cond:
+			in_flight       = self.in_flight
+			self.in_flight -= 1
+			self.cond.notify()
+
+			# The responses of the requests sent with the old limit are not used
+			if start < self.decreased:
+				return
+
+			if status is None or status == 429 or status >= 500:
+				# The request already decreased the limit in its first try
+				if not retry:
+					self.__decrease__()
+			elif status < 400 and latency is not None:
+				self.__increase__(latency, in_flight)
+
+	def __increase__(self, latency, in_flight):
+		# The base latency is the minimum latency, it follows slowly the slower servers
+		if self.base_latency is None or latency < self.base_latency:
+			self.base_latency = latency
+		else:
+			self.base_latency += 0.01 * (latency - self.base_latency)
+		self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+
+		# The limit only grows when it is used
+		if self.latency > LATENCY_FACTOR * self.base_latency or in_flight < self.size():
+			return
+
+		# Slow start doubles the limit by round, after the first decrease one request by round
+		self.limit = min(self.limit + (1 if self.slow_start else 1 / self.limit), self.ceiling)
+
+	def __decrease__(self):
+		self.decreased  = time.monotonic()
+		self.slow_start = False
+		self.limit      = max(min(self.limit, self.ceiling) / 2, self.floor)
+		print('Concurrency of {} : {}'.format(self.endpoint, self.size()))
+
+
+_limiters      = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(url, ceiling = None) -> Adaptive_limit:
+	"""
+	Return the adaptive concurrency limit of the endpoint (host and path)
+	of the url.
+	Input :
+		url     : str -> url to make request
+		ceiling : int -> Maximum concurrency of the endpoint. None for not change it
+	"""
+	parts    = urlsplit(url)
+	endpoint = parts.netloc + parts.path
+	with _limiters_lock:
+		if endpoint not in _limiters:
+			_limiters[endpoint] = Adaptive_limit(endpoint)
+		if ceiling is not None:
+			_limiters[endpoint].ceiling = ceiling
+		return _limiters[endpoint]
+
+
+def get_session() -> requests.Session:
+	"""
+	Return the shared session. The connections are kept alive and reused
+	by all the threads of the process.
+	"""
+	global _session
+	with _session_lock:
+		if _session is None:
+			_session = requests.Session()
+			_session.headers['Accept-Encoding'] = 'gzip, deflate'
+			adapter  = HTTPAdapter(pool_connections = POOL_CONNECTIONS,
+								   pool_maxsize     = POOL_MAXSIZE)
+			_session.mount('http://', adapter)
+			_session.mount('https://', adapter)
+		return _session
+
+
+def backoff_delay(attempt : int) -> float:
+	"""
+	Exponential backoff with full jitter
+	"""
+	return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def retry_after_delay(headers) -> float:
+	"""
+	Read the Retry-After header. It may be in seconds or a HTTP date.
+	Return 0 if the header does not exist.
+	"""
+	value = headers.get('Retry-After')
+	if value is None:
+		return 0
+	try:
+		return min(float(value), BACKOFF_CAP)
+	except ValueError:
+		pass
+	try:
+		date = eut.parsedate_to_datetime(value)
+		return min(max(date.timestamp() - time.time(), 0), BACKOFF_CAP)
+	except (TypeError, ValueError):
+		return 0
+
+
+def get(url, params = None, verify = True, stream = False, retries = RETRIES, headers = None):
+	"""
+	Make a request with the shared session.
+	Input :
+		url     : str  -> url to make request
+		params  : dict -> Dictionary with the params of request
+		verify  : bool -> Verify the certificate
+		stream  : bool -> Do not download the content immediately
+		retries : int  -> Number of tries
+		headers : dict -> Extra headers of the request
+	Return:
+		None              -> When the requests fail
+		requests.Response -> When success the request (status 200 or 304)
+	"""
+	session = get_session()
+	breaker = get_breaker(url)
+	limiter = get_limiter(url)
+
+	for attempt in range(retries):
+
+		# Wait if the circuit of the host is open and for a free request of the endpoint
+		time.sleep(breaker.remaining())
+		limiter.acquire()
+
+		start = time.monotonic()
+		try:
+			response = session.get(url, params = params, verify = verify, stream = stream, headers = headers)
+		except requests.RequestException:
+			limiter.release(start, retry = attempt > 0)
+			breaker.failure()
+			time.sleep(backoff_delay(attempt))
+			continue
+		limiter.release(start, response.status_code, time.monotonic() - start, retry = attempt > 0)
+
+		if response.status_code in (200, 304):
+			breaker.success()
+			return response
+
+		response.close()
+		if response.status_code in NOT_RETRY:
+			break
+
+		if response.status_code == 429 or response.status_code >= 500:
+			breaker.failure(retry_after_delay(response.headers))
+		time.sleep(backoff_delay(attempt))
+
+	return None
+
+
+def fetch(url, params = None, verify = True, cache = None):
+	"""
+	Download the content of the url. With cache, the request is conditional
+	and the responses without changes are detected.
+	Input :
+		url    : str            -> url to make request
+		params : dict           -> Dictionary with the params of request
+		verify : bool           -> Verify the certificate
+		cache  : Response_cache -> Cache of responses. None for not use cache
+	Return:
+		(None, False, commit)  -> When the requests fail
+		(bytes, bool, commit)  -> Content, True if the content changed and the
+		                          function to save the response in the cache.
+		                          Call commit after the content is stored.
+	"""
+	key     = None if cache is None else cache.key(url, params)
+	headers = {} if cache is None else cache.conditional_headers(key)
+
+	for _ in range(2):
+		response = get(url, params, verify = verify, headers = headers)
+		if response is None:
+			return None, False, _no_commit
+
+		rv = _resolve_cache(cache, key, url, response.status_code, response.headers, response.content)
+		response.close()
+
+		if rv is not None:
+			return rv
+
+		# The response is not in the cache, request without condition
+		headers = {}
+
+	return None, False, _no_commit
+
+
+def _no_commit():
+	pass
+
+
+def _resolve_cache(cache, key, url, status, headers, body):
+	"""
+	Compare the response with the cache.
+	Return:
+		None                  -> The response is not modified but it is not in the cache
+		(bytes, bool, commit) -> Content, True if the content changed and commit function
+	"""
+	if cache is None:
+		return body, True, _no_commit
+
+	if status == 304:
+		body = cache.load(key)
+		if body is None:
+			return None
+		cache.touch(key, headers)
+		return body, False, _no_commit
+
+	if cache.is_unchanged(key, body):
+		cache.touch(key, headers)
+		return body, False, _no_commit
+
+	headers = dict(headers)
+	return body, True, lambda : cache.save(key, url, headers, body)
+
+
+def write_batch(items, write, on_fail, commit = None) -> int:
+	"""
+	Write a batch of items with one call. If the batch fails, the items
+	are written one by one to find the failed items. The commit of each
+	item is called after the write, an item whose commit fails is sent to
+	on_fail but it is not written again.
+	Input :
+		items   : list -> Items of the batch
+		write   : func -> list -> None. Write the items
+		on_fail : func -> (item, exception) -> None. Called for each failed item
+		commit  : func -> item -> None. Called for each written item. None for not use
+	Return:
+		int -> Number of items written and committed
+	"""
+	try:
+		write(items)
+		written = items
+	except Exception as e:
+		if len(items) == 1:
+			on_fail(items[0], e)
+			return 0
+
+		written = []
+		for item in items:
+			try:
+				write([item])
+				written.append(item)
+			except Exception as e:
+				on_fail(item, e)
+
+	if commit is None:
+		return len(written)
+
+	rv = 0
+	for item in written:
+		try:
+			commit(item)
+			rv += 1
+		except Exception as e:
+			on_fail(item, e)
+	return rv
+
+
+def download_all(items,
+				 url_fun,
+				 parse,
+				 on_frame        = None,
+				 on_batch        = None,
+				 batch_size      : int = 50,
+				 max_concurrency : int = 50,
+				 limit_per_host  : int = 50,
+				 keepalive       : int = 60,
+				 timeout         : int = 120,
+				 retries         : int = 5,
+				 queue_size      : int = 200,
+				 ssl             = None,
+				 cache           = None,
+				 defer_commit    : bool = False) -> dict:
+	"""
+	Download all items with an asyncio engine. The connections are kept
+	alive and reused by host, the payloads are parsed in a thread pool and
+	the parsed frames are sent to the writer stage as soon as they arrive.
+	The writer stage is fed by a bounded queue, the downloaders only wait
+	for it when the queue is full.
+	Input :
+		items           : list -> Items (comids, stations) to download
+		url_fun         : func -> item -> (url, params)
+		parse           : func -> (item, payload) -> frame. The payload is
+		                          the content in bytes. Return None if
+		                          the payload is not valid, the item is
+		                          requested again
+		on_frame        : func -> (item, frame) -> None. Writer function,
+		                          it is called from a single thread
+		on_batch        : func -> [(item, frame)] -> None. Writer function
+		                          by batch, it is used instead of on_frame.
+		                          The frames waiting in the queue are written
+		                          together. If the batch fails, its items are
+		                          written one by one
+		batch_size      : int  -> Maximum number of frames by batch
+		max_concurrency : int  -> Maximum number of requests in flight. The
+		                          requests in flight by endpoint are adapted
+		                          below this value to the latency and errors
+		limit_per_host  : int  -> Maximum number of connections by host
+		keepalive       : int  -> Seconds to keep alive an idle connection
+		timeout         : int  -> Total timeout by request in seconds
+		retries         : int  -> Number of tries by item
+		queue_size      : int  -> Maximum number of frames waiting for the writer
+		ssl             : bool -> False for skip the certificate verification
+		cache           : Response_cache -> Cache of responses. The items without
+		                          changes are not parsed and not written
+		defer_commit    : bool -> True for not save the responses in the cache
+		                          after the writer function. The caller saves
+		                          them with the functions of summary['commits']
+		                          after the data is stored
+	Return:
+		dict -> {'done' : int, 'unchanged' : list, 'failed' : list,
+		         'commits' : {item : function}}. The commits are only
+		         returned with defer_commit
+	"""
+	return asyncio.run(_download_all(items           = items,
+									 url_fun         = url_fun,
+									 parse           = parse,
+									 on_frame        = on_frame,
+									 on_batch        = on_batch,
+									 batch_size      = batch_size if on_batch is not None else 1,
+									 max_concurrency = max_concurrency,
+									 limit_per_host  = limit_per_host,
+									 keepalive       = keepalive,
+									 timeout         = timeout,
+									 retries         = retries,
+									 queue_size      = queue_size,
+									 ssl             = ssl,
+									 cache           = cache,
+									 defer_commit    = defer_commit))
+
+
+async def _download_all(items, url_fun, parse, on_frame, on_batch, batch_size, max_concurrency,
+						limit_per_host, keepalive, timeout, retries, queue_size, ssl, cache, defer_commit):
+
+	loop     = asyncio.get_running_loop()
+	todo     = asyncio.Queue()
+	frames   = asyncio.Queue(maxsize = queue_size)
+	summary  = {'done' : 0, 'unchanged' : [], 'failed' : [], 'commits' : {}}
+
+	for item in items:
+		todo.put_nowait(item)
+
+	# Only one thread write to database, the lock between writers is not needed
+	writer_pool = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+
+	connector = aiohttp.TCPConnector(limit             = max_concurrency,
+									 limit_per_host    = limit_per_host,
+									 keepalive_timeout = keepalive,
+									 ttl_dns_cache     = 300,
+									 ssl               = ssl)
+
+	async with aiohttp.ClientSession(connector = connector,
+									 headers   = {'Accept-Encoding' : 'gzip, deflate'},
+									 timeout   = aiohttp.ClientTimeout(total = timeout)) as session:
+
+		async def downloader():
+			while True:
+				try:
+					item = todo.get_nowait()
+				except asyncio.QueueEmpty:
+					return
+
+				frame   = None
+				changed = True
+				for _ in range(retries):
+					payload, changed, commit = await _fetch(session, *url_fun(item),
+															cache   = cache,
+															ceiling = max_concurrency)
+					if "ERROR" == payload or not changed:
+						break
+					try:
+						frame = await loop.run_in_executor(None, parse, item, payload)
+					except Exception as e:
+						print('Exception: {}'.format(e))
+						frame = None
+					if frame is not None:
+						break
+
+				if "ERROR" == payload or (frame is None and changed):
+					summary['failed'].append(item)
+					print('Download fail : {}'.format(item))
+				elif not changed:
+					summary['unchanged'].append(item)
+				else:
+					await frames.put((item, frame, commit))
+
+		def write(batch):
+			if on_batch is not None:
+				on_batch([(item, frame) for item, frame, _ in batch])
+			else:
+				for item, frame, _ in batch:
+					on_frame(item, frame)
+
+		def commit(one):
+			# Save the response in the cache after the data is stored
+			if defer_commit:
+				summary['commits'][one[0]] = one[2]
+			else:
+				one[2]()
+
+		def write_fail(one, e):
+			summary['failed'].append(one[0])
+			print('Write fail : {}. Exception: {}'.format(one[0], e))
+
+		async def writer():
+			while True:
+				# Coalesce the frames waiting in the queue
+				batch = [await frames.get()]
+				while len(batch) < batch_size and not frames.empty():
+					batch.append(frames.get_nowait())
+
+				try:
+					summary['done'] += await loop.run_in_executor(writer_pool, write_batch, batch, write, write_fail, commit)
+				finally:
+					for _ in batch:
+						frames.task_done()
+
+		writer_task = asyncio.create_task(writer())
+		try:
+			await asyncio.gather(*[downloader() for _ in range(min(max_concurrency, max(len(items), 1)))])
+			await frames.join()
+		finally:
+			writer_task.cancel()
+			writer_pool.shutdown(wait = True)
+
+	return summary
+
+
+async def _fetch(session, url, params, retries = RETRIES, cache = None, ceiling = None):
+	"""
+	Make a request over the asynchronous session with the same backoff
+	policy, circuit breaker, adaptive limit and cache of the fetch function.
+	Return:
+		("ERROR", False, commit)  -> When the requests does not exist
+		(bytes, bool, commit)     -> Content, True if the content changed and
+		                             the function to save the response in the cache
+	"""
+	params  = {key : str(val) for key, val in params.items()}
+	breaker = get_breaker(url)
+	limiter = get_limiter(url, ceiling)
+	key     = None if cache is None else cache.key(url, params)
+	headers = {} if cache is None else cache.conditional_headers(key)
+
+	for attempt in range(retries):
+
+		# Wait if the circuit of the host is open and for a free request of the endpoint
+		await asyncio.sleep(breaker.remaining())
+		await limiter.acquire_async()
+
+		start   = time.monotonic()
+		status  = None
+		latency = None
+		try:
+			async with session.get(url, params = params, headers = headers) as response:
+				status  = response.status
+				latency = time.monotonic() - start
+				delay   = retry_after_delay(response.headers)
+				if status in (200, 304):
+					breaker.success()
+					body = await response.read()
+					rv   = _resolve_cache(cache, key, url, status, response.headers, body)
+					if rv is not None:
+						return rv
+
+					# The response is not in the cache, request without condition
+					headers = {}
+					continue
+		except (aiohttp.ClientError, asyncio.TimeoutError):
+			status = None
+		finally:
+			limiter.release(start, status, latency, retry = attempt > 0)
+
+		if status is None:
+			breaker.failure()
+			await asyncio.sleep(backoff_delay(attempt))
+			continue
+
+		if status in NOT_RETRY:
+			break
+
+		if status == 429 or status >= 500:
+			breaker.failure(delay)
+		await asyncio.sleep(backoff_delay(attempt))
+
+	return "ERROR", False, _no_commit
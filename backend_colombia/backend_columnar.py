@@ -0,0 +1,121 @@
+import os
+import pandas as pd
+
+try:
+	import pyarrow as pa
+	import pyarrow.ipc
+except ImportError:
+	pa = None
+
+from backend_storage import read_many, to_wide
+
+#                        backend_columnar.py
+# This file save the local columnar copy of the products that change
+# monthly (historical simulation). The data of each reach is saved in one
+# Arrow IPC file (datetime, value) without compression, so the analysis
+# routines read it with a memory map, without copy and without query the
+# database. The copy is written by r_historical_simulation_db.py after the
+# update of the database.
+# Optional dependence: pyarrow. Without pyarrow the data is read from the
+# database.
+# Backend routines:
+# 1. r_historical_simulation_db.py
+# 2. r_analysis_forecast.py
+# 3. r_analysis_raw_forecast.py
+# 4. r_thresholds_db.py
+#
+
+
+# Directory of the copy and reaches read from the database by query
+COLUMNAR_DIR   = os.path.join('.', 'cache', 'columnar')
+COLUMNAR_BATCH = 100
+
+
+def available() -> bool:
+	return pa is not None
+
+
+def file_name(product, comid, path = COLUMNAR_DIR) -> str:
+	return os.path.join(path, product, '{}.arrow'.format(int(comid)))
+
+
+def save(product, comid, df, path = COLUMNAR_DIR):
+	"""
+	Write the data of the reach. The file is replaced when it is complete,
+	so the readers never see a partial file.
+	Input :
+		product : str              -> Name of the product
+		comid   : int              -> comid of the reach
+		df      : pandas.DataFrame -> datetime, value
+		path    : str              -> Directory of the copy
+	"""
+	name = file_name(product, comid, path)
+	os.makedirs(os.path.dirname(name), exist_ok = True)
+
+	table = pa.table({'datetime' : pa.array(pd.DatetimeIndex(df['datetime']).values, type = pa.timestamp('ns')),
+					  'value'    : pa.array(df['value'].to_numpy(dtype = 'float64'))})
+
+	with pa.OSFile(name + '.tmp', 'wb') as sink:
+		with pa.ipc.new_file(sink, table.schema) as writer:
+			writer.write_table(table)
+	os.replace(name + '.tmp', name)
+
+
+def remove(product, comid, path = COLUMNAR_DIR):
+	"""
+	Remove the data of the reach, before its data is changed in the
+	database. The reach is written again in the next export.
+	Input :
+		product : str -> Name of the product
+		comid   : int -> comid of the reach
+		path    : str -> Directory of the copy
+	"""
+	try:
+		os.remove(file_name(product, comid, path))
+	except FileNotFoundError:
+		pass
+
+
+def load(product, comid, path = COLUMNAR_DIR):
+	"""
+	Read the data of the reach with a memory map. The arrays of the file
+	are used without copy up to the build of the table.
+	Input :
+		product : str -> Name of the product
+		comid   : int -> comid of the reach
+		path    : str -> Directory of the copy
+	Return:
+		pandas.DataFrame -> datetime column and one column of values, the
+		                    same table of backend_storage.read. None if the
+		                    reach is not in the copy
+	"""
+	name = file_name(product, comid, path)
+	if pa is None or not os.path.exists(name):
+		return None
+
+	table = pa.ipc.open_file(pa.memory_map(name, 'r')).read_all()
+	df    = pd.DataFrame({'datetime' : table.column('datetime').to_numpy(),
+						  'value'    : table.column('value').to_numpy()})
+	return to_wide(product, comid, df)
+
+
+def export(conn, product, comids, path = COLUMNAR_DIR, batch = COLUMNAR_BATCH) -> int:
+	"""
+	Write the copy of the reaches from the database. The reaches are read
+	by batches with one query.
+	Input :
+		conn    : sqlalchemy connection
+		product : str  -> Name of the product
+		comids  : list -> comids of the reaches
+		path    : str  -> Directory of the copy
+		batch   : int  -> Reaches by query
+	Return:
+		int -> Number of reaches written
+	"""
+	rv = 0
+	for ii in range(0, len(comids), batch):
+		df = read_many(conn, product, comids[ii : ii + batch])
+		for comid, data in df.groupby('comid', sort = False):
+			save(product, comid, data, path)
+			rv += 1
+	return rv
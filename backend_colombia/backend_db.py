@@ -0,0 +1,225 @@
+import io
+import os
+import atexit
+import threading
+from contextlib import contextmanager
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.engine import Engine
+
+#                        backend_db.py
+# This file save the database layer shared by the backend routines:
+# - One engine (and connection pool) by process. The routines take the
+#   connections from the pool with session() or connection(), the engine
+#   is not created or disposed in the loops by reach.
+# - The database writer. The frames are sent to postgres with COPY FROM
+#   STDIN in csv batches, instead of the INSERT by row of
+#   pandas.DataFrame.to_sql.
+# - The update of one column of a table (the alerts) in place. The new
+#   values are copied to a temporal table and applied with one UPDATE
+#   FROM, the table is not replaced.
+# Backend routines:
+# 1. backend_storage.py
+# 2. r_forecast_db.py
+# 3. r_forecast_record_db.py
+# 4. r_historical_simulation_db.py
+# 5. r_daily_ingest.py
+# 6. r_storage_db.py
+# 7. r_observed_data_db.py
+# 8. r_drainage_db.py
+# 9. r_station_db.py
+# 10. r_fews_stations.py
+# 11. r_analysis_forecast.py
+# 12. r_analysis_raw_forecast.py
+# 13. r_thresholds_db.py
+# 14. backend_thresholds.py
+#
+
+
+# Rows by COPY batch
+COPY_BATCH = 100000
+
+# Text of the missing values in the COPY csv. The empty fields are empty
+# strings, as in pandas.DataFrame.to_sql
+COPY_NULL = '\\N'
+
+# Connection pool by process. The writers of the download engine and the
+# threads of the routines take the connections from the same pool
+POOL_SIZE     = 10
+POOL_OVERFLOW = 20
+POOL_TIMEOUT  = 120
+POOL_RECYCLE  = 1800
+
+# Compiled statements cached by engine. The queries of the loops by reach
+# are the same text with other parameters, so they are compiled only once
+QUERY_CACHE = 1200
+
+_engines = {}
+_lock    = threading.Lock()
+
+
+def get_engine(db_text) -> Engine:
+	"""
+	Return the engine of the database for this process. The engine is
+	created in the first call and shared by the next calls. The processes
+	of a pool (fork) create their own engine, the connections of the parent
+	process are not used in the children.
+	Input :
+		db_text : str -> Connection url of the database
+	Return:
+		sqlalchemy.engine.Engine -> Engine with the connection pool
+	"""
+	key = (os.getpid(), db_text)
+	with _lock:
+		if key not in _engines:
+			_engines[key] = create_engine(db_text,
+										  pool_size        = POOL_SIZE,
+										  max_overflow     = POOL_OVERFLOW,
+										  pool_timeout     = POOL_TIMEOUT,
+										  pool_recycle     = POOL_RECYCLE,
+										  pool_pre_ping    = True,
+										  query_cache_size = QUERY_CACHE)
+		return _engines[key]
+
+
+@contextmanager
+def session(db_text):
+	"""
+	Connection of the pool with a transaction. The transaction is committed
+	at the end of the block, or rolled back if the block raise an exception.
+	The connection is returned to the pool.
+	Input :
+		db_text : str -> Connection url of the database
+	Return:
+		sqlalchemy connection
+	"""
+	with get_engine(db_text).begin() as conn:
+		yield conn
+
+
+@contextmanager
+def connection(db_text):
+	"""
+	Connection of the pool without transaction, to read. The connection is
+	returned to the pool at the end of the block.
+	Input :
+		db_text : str -> Connection url of the database
+	Return:
+		sqlalchemy connection
+	"""
+	with get_engine(db_text).connect() as conn:
+		yield conn
+
+
+@atexit.register
+def dispose():
+	# Close the connections of the engines of this process
+	with _lock:
+		for key in [key for key in _engines if key[0] == os.getpid()]:
+			_engines.pop(key).dispose()
+
+
+def quote(name) -> str:
+	# Quote the identifier, the column names of pandas keep the capital letters
+	return '"{}"'.format(str(name).replace('"', '""'))
+
+
+def copy_frame(conn, df, table, batch = COPY_BATCH) -> int:
+	"""
+	Copy the rows of the frame to the table. The columns of the frame must
+	exist in the table. The rows are sent by batches in csv format, so only
+	one batch is in memory as text. The missing values (NaN, None) are
+	written as NULL and the empty strings as empty strings.
+	Input :
+		conn  : sqlalchemy connection. The copy is made in the transaction of the connection
+		df    : pandas.DataFrame -> Rows to copy, the index is not copied
+		table : str              -> Name of the table
+		batch : int              -> Rows by batch
+	Return:
+		int -> Number of rows copied
+	"""
+	if df.empty:
+		return 0
+
+	query  = "copy {} ({}) from stdin with (format csv, null '{}')".format(table,
+																		 ', '.join([quote(col) for col in df.columns]),
+																		 COPY_NULL)
+	cursor = conn.connection.cursor()
+	try:
+		for ii in range(0, len(df), batch):
+			buffer = io.StringIO()
+			df.iloc[ii : ii + batch].to_csv(buffer, header = False, index = False, na_rep = COPY_NULL)
+			buffer.seek(0)
+			cursor.copy_expert(query, buffer)
+	finally:
+		cursor.close()
+
+	return len(df)
+
+
+def write_frame(conn, df, table, if_exists = 'append', index = False, batch = COPY_BATCH) -> int:
+	"""
+	Write the frame with the same arguments of pandas.DataFrame.to_sql. The
+	table is built by pandas without rows and the rows are sent with COPY.
+	Input :
+		conn      : sqlalchemy engine or connection
+		df        : pandas.DataFrame -> Data to write
+		table     : str              -> Name of the table
+		if_exists : str              -> 'replace' or 'append'
+		index     : bool             -> Write the index as a column
+		batch     : int              -> Rows by COPY batch
+	Return:
+		int -> Number of rows written
+	"""
+	if isinstance(conn, Engine):
+		with conn.begin() as session:
+			return write_frame(session, df, table, if_exists, index, batch)
+
+	if not conn.in_transaction():
+		with conn.begin():
+			return write_frame(conn, df, table, if_exists, index, batch)
+
+	if index:
+		df = df.reset_index()
+
+	# Build the table. pandas only create the columns
+	if 'replace' == if_exists or not inspect(conn).has_table(table):
+		df.head(0).to_sql(table, con = conn, if_exists = if_exists, index = False)
+
+	return copy_frame(conn, df, quote(table), batch)
+
+
+def update_column(conn, df, table, key, column) -> int:
+	"""
+	Update one column of the table from the pairs (key, column) of the
+	frame. The pairs are copied to a temporal table and applied with one
+	UPDATE FROM in the transaction of the connection, so the table keeps
+	its rows and indexes and the readers see the old values until commit.
+	Input :
+		conn   : sqlalchemy engine or connection
+		df     : pandas.DataFrame -> Columns key and column
+		table  : str              -> Name of the table
+		key    : str              -> Column to join the rows
+		column : str              -> Column to update
+	Return:
+		int -> Number of rows changed
+	"""
+	if isinstance(conn, Engine):
+		with conn.begin() as session:
+			return update_column(session, df, table, key, column)
+
+	if not conn.in_transaction():
+		with conn.begin():
+			return update_column(conn, df, table, key, column)
+
+	# The temporal table has the types of the table
+	stage = quote('{}_stage'.format(table))
+	conn.exec_driver_sql('create temporary table {0} as select {1}, {2} from {3} with no data'
+						 .format(stage, quote(key), quote(column), quote(table)))
+	copy_frame(conn, df[[key, column]], stage)
+
+	# Only the changed rows are written
+	rv = conn.exec_driver_sql('update {0} as t set {1} = s.{1} from {2} as s '
+							  'where t.{3} = s.{3} and t.{1} is distinct from s.{1}'
+							  .format(quote(table), quote(column), stage, quote(key)))
+	conn.exec_driver_sql('drop table {}'.format(stage))
+	return rv.rowcount
@@ -0,0 +1,190 @@
+import threading
+import pandas as pd
+from sqlalchemy import text
+
+#                        backend_ledger.py
+# This file save the progress ledger of the backend routines. The status
+# of each reach (pending, done, failed) is saved in postgres, so an
+# interrupted routine can be resumed with only the unfinished reaches.
+# Backend routines:
+# 1. r_forecast_db.py
+# 2. r_forecast_record_db.py
+# 3. r_historical_simulation_db.py
+# 4. r_daily_ingest.py
+#
+# The dead letter table save the reaches that failed after all the tries.
+# Backend routines:
+# 1. r_forecast_db.py
+# 2. r_daily_ingest.py
+#
+
+
+LEDGER_TABLE = 'progress_ledger'
+
+
+class Progress_ledger:
+	"""
+	Progress ledger by job and run. The run is the identifier of the
+	update (the date for daily routines, the month for monthly routines).
+	The status is saved by batches to keep the database out of the hot path.
+	"""
+	def __init__(self, db, job : str, run : str, batch : int = 100):
+		self.db     = db
+		self.job    = job
+		self.run    = run
+		self.batch  = batch
+		self.buffer = []
+		self.lock   = threading.Lock()
+
+		with self.db.begin() as conn:
+			conn.execute(text('create table if not exists {} ('
+							  'job text, '
+							  'run text, '
+							  'comid bigint, '
+							  'status text, '
+							  'message text, '
+							  'updated timestamp default now(), '
+							  'primary key (job, comid))'.format(LEDGER_TABLE)))
+
+
+	def start(self, comids : list, resume : bool = False) -> list:
+		"""
+		Start the run of the job.
+		Input:
+			comids : list -> All the comids of the job
+			resume : bool -> Process only the unfinished comids of the same run
+		Output:
+			list -> comids to process
+		"""
+		with self.db.begin() as conn:
+			ledger = pd.read_sql(text('select run, comid, status from {} where job = :job'.format(LEDGER_TABLE)),
+								 con = conn, params = {'job' : self.job})
+
+			if resume and (ledger['run'] == self.run).all() and not ledger.empty:
+				done = set(ledger.loc[ledger['status'] == 'done', 'comid'].tolist())
+				rv   = [comid for comid in comids if comid not in done]
+				print('Resume {} - {}. Reaches to update : {} of {}'.format(self.job, self.run, len(rv), len(comids)))
+				return rv
+
+			if resume:
+				print('Without run to resume for {} - {}. Start a new run.'.format(self.job, self.run))
+
+			# New run, all comids are pending
+			conn.execute(text('delete from {} where job = :job'.format(LEDGER_TABLE)), {'job' : self.job})
+			if len(comids) > 0:
+				conn.execute(text('insert into {} (job, run, comid, status) '
+								  'values (:job, :run, :comid, :status)'.format(LEDGER_TABLE)),
+							 [{'job' : self.job, 'run' : self.run, 'comid' : int(comid), 'status' : 'pending'}
+							  for comid in comids])
+
+		return list(comids)
+
+
+	def done(self, comid):
+		self.mark(comid, 'done')
+
+
+	def failed(self, comid, message = ''):
+		self.mark(comid, 'failed', message)
+
+
+	def mark(self, comid, status : str, message : str = ''):
+		# Save the status of the comid. The status is written by batch
+		with self.lock:
+			self.buffer.append({'job'     : self.job,
+								'run'     : self.run,
+								'comid'   : int(comid),
+								'status'  : status,
+								'message' : str(message)[:500]})
+			if len(self.buffer) < self.batch:
+				return
+			buffer, self.buffer = self.buffer, []
+		self.__write__(buffer)
+
+
+	def flush(self):
+		# Write the status waiting in the buffer
+		with self.lock:
+			buffer, self.buffer = self.buffer, []
+		self.__write__(buffer)
+
+
+	def __write__(self, buffer):
+		if len(buffer) == 0:
+			return
+		with self.db.begin() as conn:
+			conn.execute(text('insert into {} (job, run, comid, status, message, updated) '
+							  'values (:job, :run, :comid, :status, :message, now()) '
+							  'on conflict (job, comid) do update set '
+							  'run = excluded.run, status = excluded.status, '
+							  'message = excluded.message, updated = excluded.updated'.format(LEDGER_TABLE)),
+						 buffer)
+
+
+DEAD_LETTER_TABLE = 'dead_letter'
+
+
+class Dead_letter:
+	"""
+	Reaches that failed after all the tries of the job. The reaches are
+	kept until a later run or sweep update them. The number of attempts
+	and the reason of the last failure are saved for review.
+	"""
+	def __init__(self, db, job : str):
+		self.db  = db
+		self.job = job
+
+		with self.db.begin() as conn:
+			conn.execute(text('create table if not exists {} ('
+							  'job text, '
+							  'comid bigint, '
+							  'reason text, '
+							  'attempts integer default 1, '
+							  'first_failed timestamp default now(), '
+							  'last_failed timestamp default now(), '
+							  'primary key (job, comid))'.format(DEAD_LETTER_TABLE)))
+
+
+	def comids(self, max_attempts : int = None) -> list:
+		"""
+		Reaches in the dead letter table of the job.
+		Input:
+			max_attempts : int -> Skip the reaches with more attempts. None for all
+		Output:
+			list -> comids to retry
+		"""
+		query  = 'select comid from {} where job = :job'.format(DEAD_LETTER_TABLE)
+		params = {'job' : self.job}
+		if max_attempts is not None:
+			query += ' and attempts < :max_attempts'
+			params['max_attempts'] = max_attempts
+		with self.db.begin() as conn:
+			return [row[0] for row in conn.execute(text(query + ' order by comid'), params)]
+
+
+	def add(self, failed : dict):
+		"""
+		Save the failed reaches.
+		Input:
+			failed : dict -> {comid : reason}
+		"""
+		if len(failed) == 0:
+			return
+		with self.db.begin() as conn:
+			conn.execute(text('insert into {0} (job, comid, reason) '
+							  'values (:job, :comid, :reason) '
+							  'on conflict (job, comid) do update set '
+							  'reason = excluded.reason, '
+							  'attempts = {0}.attempts + 1, '
+							  'last_failed = now()'.format(DEAD_LETTER_TABLE)),
+						 [{'job' : self.job, 'comid' : int(comid), 'reason' : str(reason)[:500]}
+						  for comid, reason in failed.items()])
+
+
+	def remove(self, comids : list):
+		# Remove the reaches updated
+		if len(comids) == 0:
+			return
+		with self.db.begin() as conn:
+			conn.execute(text('delete from {} where job = :job and comid = any(:comids)'.format(DEAD_LETTER_TABLE)),
+						 {'job' : self.job, 'comids' : [int(comid) for comid in comids]})
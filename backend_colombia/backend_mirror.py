@@ -0,0 +1,177 @@
+import os
+import numpy as np
+import pandas as pd
+
+try:
+	import xarray as xr
+except ImportError:
+	xr = None
+
+#                        backend_mirror.py
+# This file read the GEOGloWS forecast files from a local mirror (NetCDF
+# or Zarr) as an alternative source of the ForecastEnsembles and
+# ForecastRecords services. The file is read once, the reaches of the
+# drainage table are selected with one index lookup and the frames are
+# returned with the same columns of the services.
+# Optional dependence: xarray (and netCDF4 or zarr for the format of the file)
+# Backend routines:
+# 1. r_forecast_db.py
+# 2. r_forecast_record_db.py
+#
+
+
+# Names of the GEOGloWS forecast files
+dict_mirror = {'Variable name'        : 'Qout',
+			   'Reach dimension'      : ['rivid', 'river_id', 'reach_id'],
+			   'Time dimension'       : 'time',
+			   'Ensemble dimension'   : 'ensemble',
+			   'Datetime column name' : 'datetime',
+			   'Ensemble column name' : 'ensemble_{:02d}_m^3/s',
+			   'Record column name'   : 'streamflow_m^3/s'}
+
+
+def open_mirror(path):
+	"""
+	Open the forecast file of the mirror. The directories and the paths
+	ended with .zarr are read as Zarr, the others as NetCDF.
+	Input :
+		path : str -> Path of the file
+	Return:
+		xarray.DataArray -> Discharge of the file
+	"""
+	if xr is None:
+		raise ImportError('xarray is required to read the forecast mirror')
+
+	if os.path.isdir(path) or path.rstrip('/').endswith('.zarr'):
+		ds = xr.open_zarr(path)
+	else:
+		ds = xr.open_dataset(path)
+
+	return ds[dict_mirror['Variable name']]
+
+
+def select_reaches(data, comids):
+	"""
+	Select the reaches of the comids with one vectorized index lookup. The
+	reaches are read in the order of the file for a sequential read.
+	Input :
+		data   : xarray.DataArray -> Discharge of the file
+		comids : list             -> comids to select
+	Return:
+		xarray.DataArray -> Discharge of the reaches found (loaded in memory)
+		list             -> comids not found in the file
+	"""
+	dim    = __reach_dimension__(data)
+	rivids = pd.Index(data[dim].values)
+	comids = np.asarray(comids, dtype = rivids.dtype)
+
+	idx     = rivids.get_indexer(comids)
+	missing = comids[idx < 0].tolist()
+	idx     = np.sort(idx[idx >= 0])
+
+	return data.isel({dim : idx}).load(), missing
+
+
+def iter_forecast(path, comids):
+	"""
+	Read the ensemble forecast of the comids from the mirror.
+	Input :
+		path   : str  -> Path of the forecast file (reach x time x ensemble)
+		comids : list -> comids to read
+	Return:
+		generator -> (comid, pandas.DataFrame) with the columns of ForecastEnsembles
+		list      -> comids not found in the file
+	"""
+	data, missing = select_reaches(open_mirror(path), comids)
+	dim           = __reach_dimension__(data)
+	data          = data.transpose(dim, dict_mirror['Time dimension'], dict_mirror['Ensemble dimension'])
+
+	index   = __datetime_index__(data)
+	columns = [dict_mirror['Ensemble column name'].format(int(ii))
+			   for ii in data[dict_mirror['Ensemble dimension']].values]
+	values  = data.values
+
+	def frames():
+		for num, comid in enumerate(data[dim].values):
+			df = pd.DataFrame(values[num], index = index, columns = columns)
+			# The high resolution ensemble has less time steps
+			yield int(comid), df.dropna(how = 'all')
+
+	return frames(), missing
+
+
+def iter_record(path, comids, start_date = None):
+	"""
+	Read the forecast record of the comids from the mirror.
+	Input :
+		path       : str  -> Path of the record file (reach x time)
+		comids     : list -> comids to read
+		start_date : str  -> First date to read (YYYYMMDD). None for all
+	Return:
+		generator -> (comid, pandas.DataFrame) with the columns of ForecastRecords
+		list      -> comids not found in the file
+	"""
+	data = open_mirror(path)
+	if start_date is not None:
+		data = data.sel({dict_mirror['Time dimension'] : slice(pd.to_datetime(start_date), None)})
+
+	data, missing = select_reaches(data, comids)
+	dim           = __reach_dimension__(data)
+	data          = data.transpose(dim, dict_mirror['Time dimension'])
+
+	index  = __datetime_index__(data)
+	values = data.values
+
+	def frames():
+		for num, comid in enumerate(data[dim].values):
+			df = pd.DataFrame({dict_mirror['Record column name'] : values[num]}, index = index)
+			yield int(comid), df.dropna()
+
+	return frames(), missing
+
+
+def read_product(path, product, comids, start_date = None, batch_size = 50):
+	"""
+	Read the product of the comids from the mirror by batches of reaches,
+	for the writers by batch of the routines.
+	Input :
+		path       : str  -> Path of the file of the product
+		product    : str  -> 'forecast' or 'forecast_record'
+		comids     : list -> comids to read
+		start_date : str  -> First date of the record to read (YYYYMMDD). None for all
+		batch_size : int  -> Number of reaches by batch
+	Return:
+		generator -> [(comid, pandas.DataFrame)] by batch
+		list      -> comids not found in the file
+	"""
+	if 'forecast' == product:
+		frames, missing = iter_forecast(path, comids)
+	elif 'forecast_record' == product:
+		frames, missing = iter_record(path, comids, start_date)
+	else:
+		raise ValueError('{} is not a product of the mirror'.format(product))
+
+	def batches():
+		batch = []
+		for comid, df in frames:
+			batch.append((comid, df))
+			if len(batch) == batch_size:
+				yield batch
+				batch = []
+
+		if len(batch) > 0:
+			yield batch
+
+	return batches(), missing
+
+
+def __reach_dimension__(data):
+	for dim in dict_mirror['Reach dimension']:
+		if dim in data.dims:
+			return dim
+	raise KeyError('Reach dimension not found in {}'.format(data.dims))
+
+
+def __datetime_index__(data):
+	return pd.DatetimeIndex(data[dict_mirror['Time dimension']].values,
+							name = dict_mirror['Datetime column name'])
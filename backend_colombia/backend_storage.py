@@ -0,0 +1,313 @@
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from backend_db import copy_frame
+
+#                        backend_storage.py
+# This file save the storage layer of the GEOGloWS products and the
+# observed data. Each product is saved in one long format table keyed by
+# (comid, datetime), or (codigo, datetime) for the stations, partitioned
+# by hash of the key. The ensemble products save the members of each
+# timestamp packed in one float32 array (real[]) instead of a row by
+# member. The reads of one reach are index range scans and the reads of
+# many reaches are made with one query. The rows are written with COPY.
+# Backend routines:
+# 1. r_forecast_db.py
+# 2. r_forecast_record_db.py
+# 3. r_historical_simulation_db.py
+# 4. r_daily_ingest.py
+# 5. r_analysis_forecast.py
+# 6. r_analysis_raw_forecast.py
+# 7. r_storage_db.py
+# 8. backend_columnar.py
+# 9. r_observed_data_db.py
+# 10. r_thresholds_db.py
+#
+
+
+# Number of partitions by table
+N_PARTITIONS = 16
+
+# Products
+dict_products = {'forecast'              : {'Table name'  : 'forecast_ensemble',
+											'Key name'    : 'comid',
+											'Key type'    : 'bigint',
+											'Ensemble'    : True,
+											'Members'     : 52,
+											'Column name' : 'ensemble_{:02d}_m^3/s'.format},
+				 'forecast_record'       : {'Table name'  : 'forecast_record',
+											'Key name'    : 'comid',
+											'Key type'    : 'bigint',
+											'Ensemble'    : False,
+											'Column name' : 'c_{}'.format},
+				 'historical_simulation' : {'Table name'  : 'historical_simulation',
+											'Key name'    : 'comid',
+											'Key type'    : 'bigint',
+											'Ensemble'    : False,
+											'Column name' : 'c_{}'.format},
+				 'observed_streamflow'   : {'Table name'  : 'observed_streamflow',
+											'Key name'    : 'codigo',
+											'Key type'    : 'text',
+											'Ensemble'    : False,
+											'Column name' : 's_{}'.format},
+				 'observed_waterlevel'   : {'Table name'  : 'observed_waterlevel',
+											'Key name'    : 'codigo',
+											'Key type'    : 'text',
+											'Ensemble'    : False,
+											'Column name' : 's_{}'.format}}
+
+_created = set()
+
+
+def create_table(conn, product):
+	"""
+	Create the table of the product and its partitions if they do not exist
+	Input :
+		conn    : sqlalchemy connection
+		product : str -> Name of the product
+	"""
+	if product in _created:
+		return
+
+	table = dict_products[product]['Table name']
+	key   = dict_products[product]['Key name']
+	value = 'real[]' if dict_products[product]['Ensemble'] else 'double precision'
+
+	conn.execute(text('create table if not exists {0} ({1} {2} not null, datetime timestamp not null, '
+					  'value {3}, primary key ({1}, datetime)) '
+					  'partition by hash ({1})'.format(table, key, dict_products[product]['Key type'], value)))
+	for ii in range(N_PARTITIONS):
+		conn.execute(text('create table if not exists {0}_p{1} partition of {0} '
+						  'for values with (modulus {2}, remainder {1})'.format(table, ii, N_PARTITIONS)))
+	_created.add(product)
+
+
+def to_long(product, comid, df) -> pd.DataFrame:
+	"""
+	Transform the table of the reach to the long format
+	Input :
+		product : str              -> Name of the product
+		comid   : int              -> comid of the reach
+		df      : pandas.DataFrame -> Table with datetime index and a column
+		                              by ensemble (or one column of values)
+	Return:
+		pandas.DataFrame -> comid, datetime, value. Without nan values. For
+		                    the ensemble products the value is the text of
+		                    the array of members
+	"""
+	if dict_products[product]['Ensemble']:
+		return to_array(product, comid, df)
+
+	values = df.to_numpy(dtype = 'float64')[:, 0]
+	rv     = pd.DataFrame({dict_products[product]['Key name'] : keys(product, [comid])[0],
+						   'datetime'                         : pd.DatetimeIndex(df.index).values,
+						   'value'                            : values})
+
+	return rv[~np.isnan(values)]
+
+
+def to_array(product, comid, df) -> pd.DataFrame:
+	"""
+	Pack the members of each timestamp in one float32 array. The missing
+	members (the high resolution member has less timestamps) are NaN.
+	Input :
+		product : str              -> Name of the product
+		comid   : int              -> comid of the reach
+		df      : pandas.DataFrame -> Table with datetime index and a column by ensemble
+	Return:
+		pandas.DataFrame -> comid, datetime, value. The value is the text of
+		                    the postgres array, for COPY
+	"""
+	# ensemble_01_m^3/s -> 1
+	members = np.array([int(column.split('_')[1]) for column in df.columns], dtype = 'int64')
+	values  = np.full((len(df), dict_products[product]['Members']), np.nan, dtype = 'float32')
+	values[:, members - 1] = df.to_numpy(dtype = 'float32')
+
+	keep   = ~np.isnan(values).all(axis = 1)
+	values = values[keep]
+
+	# The members are formatted by numpy with the shortest text of the float32 value
+	rows = values.astype(str).tolist()
+	return pd.DataFrame({'comid'    : int(comid),
+						 'datetime' : pd.DatetimeIndex(df.index).values[keep],
+						 'value'    : ['{' + ','.join(row) + '}' for row in rows]})
+
+
+def to_wide(product, comid, df) -> pd.DataFrame:
+	"""
+	Transform the long format to the table of the reach, the same table of
+	the old f_, fr_ and hs_ tables.
+	Input :
+		product : str              -> Name of the product
+		comid   : int              -> comid of the reach
+		df      : pandas.DataFrame -> datetime, value
+	Return:
+		pandas.DataFrame -> datetime column and one column of values
+	"""
+	name = dict_products[product]['Column name']
+
+	rv = df.set_index('datetime')[['value']].rename(columns = {'value' : name(comid)})
+	rv.index.name = 'datetime'
+	return rv.sort_index().reset_index()
+
+
+def write(conn, product, comid, df, mode = 'replace') -> int:
+	"""
+	Write the table of the reach
+	Input :
+		conn    : sqlalchemy connection. Use a transaction for replace
+		product : str              -> Name of the product
+		comid   : int              -> comid of the reach
+		df      : pandas.DataFrame -> Table with datetime index
+		mode    : str              -> 'replace' : Remove the stored data of the reach
+		                              'append'  : Insert only the new timestamps
+	Return:
+		int -> Number of rows sent to the table
+	"""
+	return write_many(conn, product, [(comid, df)], mode)
+
+
+def write_many(conn, product, frames, mode = 'replace') -> int:
+	"""
+	Write the tables of many reaches with one delete and one copy
+	Input :
+		conn    : sqlalchemy connection. Use a transaction for replace
+		product : str  -> Name of the product
+		frames  : list -> [(comid, pandas.DataFrame)]. Tables with datetime index
+		mode    : str  -> 'replace' : Remove the stored data of the reaches
+		                  'append'  : Insert only the new timestamps
+	Return:
+		int -> Number of rows sent to the table
+	"""
+	if len(frames) == 0:
+		return 0
+
+	table  = dict_products[product]['Table name']
+	key    = dict_products[product]['Key name']
+	comids = keys(product, [comid for comid, _ in frames])
+	rv     = pd.concat([to_long(product, comid, df) for comid, df in frames], ignore_index = True)
+
+	try:
+		create_table(conn, product)
+		if 'replace' == mode:
+			conn.execute(text('delete from {} where {} = any(:comids)'.format(table, key)), {'comids' : comids})
+			copy_frame(conn, rv, table)
+		else:
+			# COPY does not skip the stored keys, the rows are copied to a temporal table first
+			conn.execute(text('create temporary table if not exists {0}_new (like {0})'.format(table)))
+			copy_frame(conn, rv, '{}_new'.format(table))
+			conn.execute(text('insert into {0} select * from {0}_new on conflict do nothing'.format(table)))
+			conn.execute(text('truncate {}_new'.format(table)))
+	except Exception:
+		# The creation of the table could be rolled back with the transaction
+		_created.discard(product)
+		raise
+
+	return len(rv)
+
+
+def read(conn, product, comid) -> pd.DataFrame:
+	"""
+	Read the table of the reach
+	Input :
+		conn    : sqlalchemy connection
+		product : str -> Name of the product
+		comid   : int -> comid of the reach
+	Return:
+		pandas.DataFrame -> datetime column and a column by ensemble (or one column of values)
+	"""
+	if dict_products[product]['Ensemble']:
+		_, dates, values = read_members(conn, product, [comid])
+
+		# Only the members with data, as the old f_ tables
+		name  = dict_products[product]['Column name']
+		found = ~np.isnan(values).all(axis = 0)
+		rv    = pd.DataFrame(values[:, found].astype('float64'),
+							 index   = pd.DatetimeIndex(dates, name = 'datetime'),
+							 columns = [name(int(ii)) for ii in np.flatnonzero(found) + 1])
+		return rv.reset_index()
+
+	df = read_many(conn, product, [comid])
+	return to_wide(product, comid, df.drop(columns = dict_products[product]['Key name']))
+
+
+def read_many(conn, product, comids) -> pd.DataFrame:
+	"""
+	Read the data of many reaches with one query
+	Input :
+		conn    : sqlalchemy connection
+		product : str  -> Name of the product
+		comids  : list -> comids of the reaches
+	Return:
+		pandas.DataFrame -> comid, datetime, [ensemble], value
+	"""
+	if dict_products[product]['Ensemble']:
+		comid, dates, values = read_members(conn, product, comids)
+		rv = pd.DataFrame({'comid'    : np.repeat(comid, values.shape[1]),
+						   'datetime' : np.repeat(dates, values.shape[1]),
+						   'ensemble' : np.tile(np.arange(1, values.shape[1] + 1, dtype = 'int16'), len(values)),
+						   'value'    : values.ravel().astype('float64')})
+		return rv[~np.isnan(rv['value'].values)].reset_index(drop = True)
+
+	table = dict_products[product]['Table name']
+	key   = dict_products[product]['Key name']
+	return pd.read_sql(text('select {1}, datetime, value from {0} where {1} = any(:comids) '
+							'order by {1}, datetime'.format(table, key)),
+					   con = conn, params = {'comids' : keys(product, comids)},
+					   parse_dates = ['datetime'])
+
+
+def read_members(conn, product, comids):
+	"""
+	Read the arrays of members of an ensemble product directly to numpy,
+	without a column by member in pandas.
+	Input :
+		conn    : sqlalchemy connection
+		product : str  -> Name of the ensemble product
+		comids  : list -> comids of the reaches
+	Return:
+		numpy.ndarray -> comid of each row
+		numpy.ndarray -> datetime64 of each row
+		numpy.ndarray -> float32 (rows, members). Missing members are NaN
+	"""
+	table = dict_products[product]['Table name']
+	rows  = conn.execute(text('select comid, datetime, value from {} where comid = any(:comids) '
+							  'order by comid, datetime'.format(table)),
+						 {'comids' : [int(comid) for comid in comids]}).fetchall()
+
+	members = dict_products[product]['Members']
+	if len(rows) == 0:
+		return np.empty(0, dtype = 'int64'), np.empty(0, dtype = 'datetime64[ns]'), np.empty((0, members), dtype = 'float32')
+
+	comid, dates, values = zip(*rows)
+	return (np.array(comid, dtype = 'int64'),
+			np.array(dates, dtype = 'datetime64[ns]'),
+			np.array(values, dtype = 'float32'))
+
+
+def last_dates(conn, product, comids) -> dict:
+	"""
+	Read the last date stored of each reach. Each date is read from the
+	index of the table.
+	Input :
+		conn    : sqlalchemy connection
+		product : str  -> Name of the product
+		comids  : list -> comids of the reaches
+	Return:
+		dict -> {comid : pandas.Timestamp}. Without the reaches not stored
+	"""
+	create_table(conn, product)
+	table = dict_products[product]['Table name']
+	key   = dict_products[product]['Key name']
+	last  = pd.read_sql(text('select c.comid, (select max(datetime) from {0} where {1} = c.comid) as last '
+							 'from unnest(cast(:comids as {2}[])) as c(comid)'.format(table, key,
+																					  dict_products[product]['Key type'])),
+						con = conn, params = {'comids' : keys(product, comids)}).dropna()
+	return dict(zip(last['comid'].tolist(), pd.to_datetime(last['last'])))
+
+
+def keys(product, comids) -> list:
+	# comids with the type of the key of the table
+	cast = str if 'text' == dict_products[product]['Key type'] else int
+	return [cast(comid) for comid in comids]
@@ -0,0 +1,194 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+from sqlalchemy import text
+
+from backend_auxiliar import gumbel_1
+from backend_db import copy_frame, quote
+
+#                        backend_thresholds.py
+# This file save the flood and low flow thresholds of the reaches and the
+# stations. The thresholds are computed from the historical simulation,
+# that only change monthly, so they are computed by r_thresholds_db.py
+# after the update of the historical simulation and saved in the
+# thresholds table. The daily alerts read the table and compare the
+# forecast with the thresholds (get_exceedance).
+# Backend routines:
+# 1. r_thresholds_db.py
+# 2. r_analysis_forecast.py
+# 3. r_analysis_raw_forecast.py
+#
+
+
+# Return periods of the flood thresholds
+RETURN_PERIODS = [100, 50, 25, 10, 5, 2]
+
+# Columns of the thresholds table
+dict_thresholds = {'Table name'        : 'thresholds',
+				   'Return period name': 'return_period_{}'.format,
+				   'Distribution name' : 'low_distribution',
+				   'Low warning name'  : '7q10'}
+
+
+def get_return_periods(data) -> dict:
+	"""
+	Flood thresholds. Gumbel distribution of the annual maximums
+	Input :
+		data : pandas.DataFrame -> Historical series with datetime index
+	Return:
+		dict -> {'return_period_100' : float, ..., 'return_period_2' : float}
+	"""
+	max_annual_flow = data.groupby(data.index.year).max()
+	mean_value      = np.mean(max_annual_flow.iloc[:,0].values)
+	std_value       = np.std(max_annual_flow.iloc[:,0].values)
+
+	return {dict_thresholds['Return period name'](rp) : gumbel_1(std_value, mean_value, rp)
+			for rp in RETURN_PERIODS}
+
+
+def get_low_warning(data) -> tuple:
+	"""
+	Low flow threshold (7Q10). Minimum annual of the 7 days moving average
+	fitted to the distribution closest to the empirical distribution.
+	Input :
+		data : pandas.DataFrame -> Historical series with datetime index
+	Return:
+		str   -> Name of the selected distribution
+		float -> 7Q10 value
+	"""
+	# Previous datatime manager
+	data_cp = data.copy()
+	data_cp = data_cp.rolling(window=7).mean()
+	ts      = data_cp.groupby(data_cp.index.year).min().values.flatten()
+
+	# Result dictionary
+	rv = {'norm'      : {'fun'  : stats.norm,
+						 'para' : {'loc'   : np.nanmean(ts),
+								   'scale' : np.nanstd(ts)}},
+		  'pearson3'  : {'fun'  : stats.pearson3,
+						 'para' : {'loc'   : np.nanmean(ts),
+								   'scale' : np.nanstd(ts),
+								   'skew'  : 1}},
+		  'dweibull'  : {'fun'  : stats.dweibull,
+						 'para' : {'loc'   : np.nanmean(ts),
+								   'scale' : np.nanstd(ts),
+								   'c'     : 1}},
+		  'chi2'      : {'fun'  : stats.chi2,
+						 'para' : {'loc'   : np.nanmean(ts),
+								   'scale' : np.nanstd(ts),
+								   'df'    : 2}},
+		  'gumbel_r'  : {'fun'  : stats.gumbel_r,
+						 'para' : {'loc'   : np.nanmean(ts) - 0.45005 * np.nanstd(ts),
+								   'scale' : 0.7797 * np.nanstd(ts)}}}
+
+	# Extract empirical distribution data
+	freq, cl = np.histogram(ts, bins='sturges')
+	freq     = np.cumsum(freq) / np.sum(freq)
+	cl_marc  = (cl[1:] + cl[:-1]) / 2
+
+	# Select the distribution with the lowest xi test. The first one in case of tie
+	xi2 = [np.square(np.subtract(rv[p_dist]['fun'].cdf(x = cl_marc, **rv[p_dist]['para']), freq)).mean() ** (1/2)
+		   for p_dist in rv]
+	best_p_dist = list(rv)[int(np.argsort(xi2, kind = 'stable')[0])]
+
+	# TODO: Fix in case of small rivers get 7q10 negative
+	val = rv[best_p_dist]['fun'](**rv[best_p_dist]['para']).ppf(1/10)
+	return best_p_dist, float(val) if val > 0 else 0
+
+
+def get_thresholds(data) -> dict:
+	"""
+	All the thresholds of the historical series
+	Input :
+		data : pandas.DataFrame -> Historical series with datetime index
+	Return:
+		dict -> One row of the thresholds table, without the source and the id
+	"""
+	rv = get_return_periods(data)
+	rv[dict_thresholds['Distribution name']], rv[dict_thresholds['Low warning name']] = get_low_warning(data)
+	return rv
+
+
+def get_exceedance(dates, ensem, rperiods) -> np.ndarray:
+	"""
+	Percent of the members of the ensemble over each return period by day.
+	The day i is the window [start + i days, start + i + 1 days], with both
+	limits included (as the .loc slice of the first alerts). The maximum of
+	each member by day is taken in one reduction and compared with all the
+	return periods at once. A day without rows of the forecast (a gap of
+	the data) has 0 % of exceedance.
+	Input :
+		dates    : pandas.DatetimeIndex -> Dates of the forecast, the first and the last are the limits
+		ensem    : pandas.DataFrame     -> Ensemble with datetime index (sorted) and a column by member
+		rperiods : pandas.DataFrame     -> Return periods of the reach (one row)
+	Return:
+		numpy.ndarray -> (days, return periods) in the order of RETURN_PERIODS.
+		                 Percent over 52 members, rounded
+	"""
+	startdate = dates[0]
+	enddate   = dates[-1]
+	bounds    = (startdate + pd.to_timedelta(np.arange((enddate - startdate).days + 2), unit = 'D')).values
+
+	# Rows of each day. The rows of the limit between two days are in both days
+	times = ensem.index.values
+	lo    = np.searchsorted(times, bounds[:-1], side = 'left')
+	hi    = np.searchsorted(times, bounds[1:],  side = 'right')
+
+	# Maximum by day and member. The row of nan is only a limit for the last day. The
+	# reduction of a day without rows is not valid and it is replaced by nan
+	values = np.vstack([ensem.to_numpy(dtype = 'float64'), np.full((1, ensem.shape[1]), np.nan)])
+	maxima = np.maximum.reduceat(values, np.column_stack([lo, hi]).ravel(), axis = 0)[::2]
+	maxima[hi <= lo] = np.nan
+
+	thresholds = rperiods[[dict_thresholds['Return period name'](rp) for rp in RETURN_PERIODS]]\
+					.to_numpy(dtype = 'float64')[0]
+	count = (maxima[:, :, None] > thresholds[None, None, :]).sum(axis = 1)
+	return np.round(count * 100 / 52)
+
+
+def create_table(conn):
+	columns = ', '.join(['{} double precision'.format(dict_thresholds['Return period name'](rp)) for rp in RETURN_PERIODS])
+	conn.execute(text('create table if not exists {0} (source text not null, id text not null, {1}, '
+					  '{2} text, {3} double precision, primary key (source, id))'
+					  .format(dict_thresholds['Table name'],
+							  columns,
+							  dict_thresholds['Distribution name'],
+							  quote(dict_thresholds['Low warning name']))))
+
+
+def write_thresholds(conn, source, df) -> int:
+	"""
+	Replace the thresholds of the source
+	Input :
+		conn   : sqlalchemy connection. Use a transaction
+		source : str              -> Table of the reaches or stations (drainage, stations_streamflow, ...)
+		df     : pandas.DataFrame -> Thresholds with the id (comid or codigo) as index
+	Return:
+		int -> Number of rows written
+	"""
+	create_table(conn)
+	conn.execute(text('delete from {} where source = :source'.format(dict_thresholds['Table name'])),
+				 {'source' : source})
+
+	rv = df.copy()
+	rv.index = rv.index.astype(str)
+	rv.index.name = 'id'
+	rv = rv.reset_index()
+	rv.insert(0, 'source', source)
+	return copy_frame(conn, rv, dict_thresholds['Table name'])
+
+
+def read_thresholds(conn, source) -> pd.DataFrame:
+	"""
+	Read the thresholds of the source
+	Input :
+		conn   : sqlalchemy connection
+		source : str -> Table of the reaches or stations
+	Return:
+		pandas.DataFrame -> Thresholds with the id (as str) as index. Empty
+		                    if the thresholds were not computed
+	"""
+	create_table(conn)
+	rv = pd.read_sql(text('select * from {} where source = :source'.format(dict_thresholds['Table name'])),
+					 con = conn, params = {'source' : source})
+	return rv.drop(columns = 'source').set_index('id')
@@ -6,5 +6,5 @@ cd /home/jrc/colombia-tethys-apps/CIAT-backend_colombia/backend_colombia
 eval "$(conda shell.bash hook)"
 conda activate gess
 
-python r_historical_simulation_db.py
+python r_historical_simulation_db.py --workers 8 --concurrency 16 && python r_thresholds_db.py
 